@@ -2,8 +2,10 @@
 building under for the purpose of selecting the correct paths and targets.
 """
 
+import functools
 import platform
 
+@functools.lru_cache(maxsize=None)
 def system() -> str:
     """Returns a canonicalized OS type. Will be one of 'linux' or 'darwin'
     as Windows is unsupported at the moment."""
@@ -20,17 +22,20 @@ def is_linux() -> bool:
 def is_darwin() -> bool:
     return platform.system() == 'Darwin'
 
+@functools.lru_cache(maxsize=None)
 def prebuilt() -> str:
     """Returns the prebuilt subdirectory for prebuilts which do not use
     subarch specialization."""
     return system() + '-x86'
 
+@functools.lru_cache(maxsize=None)
 def prebuilt_full() -> str:
     """Returns the prebuilt subdirectory for prebuilts which have subarch
     specialization available.
     """
     return system() + '-x86_64'
 
+@functools.lru_cache(maxsize=None)
 def triple() -> str:
     """Returns the target triple of the build environment."""
     build_os = system()
@@ -40,6 +45,7 @@ def triple() -> str:
         return 'x86_64-apple-darwin'
     raise RuntimeError("Unknown OS: " + build_os)
 
+@functools.lru_cache(maxsize=None)
 def alt_triples() -> list[str]:
     """Returns the multilib targets for the build environment."""
     build_os = system()
@@ -14,9 +14,11 @@
 """Handles generation of config.toml for the rustc build."""
 
 import argparse
+import concurrent.futures
+import functools
+import json
 import os
 import subprocess
-import stat
 from string import Template
 
 import build_platform
@@ -45,27 +47,145 @@ HOST_TARGET_TEMPLATE:           Path = TEMPLATES_PATH / 'host_target.template'
 LINKER_PIC_FLAG:     str = '-Wl,-mllvm,-relocation-model=pic'
 MACOSX_VERSION_FLAG: str = '-mmacosx-version-min=10.14'
 
-
-def instantiate_template_exec(template_path: Path, output_path: Path, **kwargs):
-    instantiate_template_file(template_path, output_path, make_exec=True, **kwargs)
-
-def instantiate_template_file(template_path: Path, output_path: Path, make_exec: bool = False, **kwargs) -> None:
-    with open(template_path) as template_file:
-        template = Template(template_file.read())
-        with open(output_path, 'w') as output_file:
-            output_file.write(template.substitute(**kwargs))
-    if make_exec:
-        output_path.chmod(output_path.stat().st_mode | stat.S_IEXEC)
-
-
-def host_config(target: str, macosx_flags: str, linker_flags: str) -> str:
-    cc_wrapper_name     = OUT_PATH_WRAPPERS / ('clang-%s' % target)
-    cxx_wrapper_name    = OUT_PATH_WRAPPERS / ('clang++-%s' % target)
-    linker_wrapper_name = OUT_PATH_WRAPPERS / ('linker-%s' % target)
+# String forms of paths interpolated into flags, converted once at import.
+GCC_TOOLCHAIN_STR:    str = GCC_TOOLCHAIN_PATH.as_posix()
+LLVM_CXX_RUNTIME_STR: str = LLVM_CXX_RUNTIME_PATH.as_posix()
+
+# Prebuilt tool directories prepended to PATH for the build, joined once at
+# import time since they never change within a run.
+PATH_PREBUILT_PREFIX: str = os.pathsep.join(p.as_posix() for p in [
+    RUST_PREBUILT_PATH / 'bin',
+    CMAKE_PREBUILT_PATH / 'bin',
+    NINJA_PREBUILT_PATH,
+    BUILD_TOOLS_PREBUILT_PATH,
+])
+
+
+@functools.lru_cache(maxsize=None)
+def _macos_sdk_path() -> str:
+    """Returns the macOS SDK path reported by xcrun.
+
+    xcrun is slow (~100ms) and its answer only changes when the selected
+    Xcode does, so the (developer dir, sdk path) pair is persisted under
+    OUT_PATH and reused while xcode-select still reports the same developer
+    dir.  On pre-Mojave, xcrun will output the empty string.
+    """
+    # An explicitly selected SDK wins without forking anything.
+    sdkroot = os.environ.get('SDKROOT')
+    if sdkroot:
+        return sdkroot
+
+    developer_dir = subprocess.check_output(
+        ['xcode-select', '-p']).rstrip().decode('utf-8')
+
+    cache_path = OUT_PATH / '.xcrun_sdk_cache'
+    try:
+        cached_developer_dir, cached_sdk_path = cache_path.read_text().split('\n')
+        if cached_developer_dir == developer_dir:
+            return cached_sdk_path
+    except (OSError, ValueError):
+        pass
+
+    sdk_path = subprocess.check_output(
+        ['xcrun', '--sdk', 'macosx', '--show-sdk-path']).rstrip().decode('utf-8')
+
+    try:
+        cache_path.write_text(developer_dir + '\n' + sdk_path)
+    except OSError:
+        pass
+
+    return sdk_path
+
+
+@functools.lru_cache(maxsize=None)
+def _load_template(template_path: Path):
+    """Reads a template and compiles it into a rendering function.
+
+    Template.substitute re-scans the whole template with a regex on every
+    call.  The templates here are rendered once per target, so split each
+    one into literal and placeholder tokens a single time and render by
+    joining.  Template's own pattern is used for the scan, keeping the
+    $name/${name}/$$ semantics identical.
+    """
+    source = template_path.read_text()
+
+    # A template without a single '$' cannot contain placeholders; render it
+    # as a constant without any token scan.
+    if '$' not in source:
+        return lambda **kwargs: source
+
+    tokens: list[tuple[bool, str]] = []
+    pos = 0
+    for match in Template.pattern.finditer(source):
+        tokens.append((False, source[pos:match.start()]))
+        name = match.group('named') or match.group('braced')
+        if name is not None:
+            tokens.append((True, name))
+        elif match.group('escaped') is not None:
+            tokens.append((False, '$'))
+        else:
+            raise ValueError('Invalid placeholder in ' + template_path.as_posix())
+        pos = match.end()
+    tokens.append((False, source[pos:]))
+
+    def render(**kwargs) -> str:
+        return ''.join(str(kwargs[text]) if is_placeholder else text
+                       for is_placeholder, text in tokens)
+
+    return render
+
+
+def instantiate_template_exec(template_path: Path, output_path: Path,
+                              dir_fd: int = None, **kwargs):
+    instantiate_template_file(template_path, output_path, make_exec=True,
+                              dir_fd=dir_fd, **kwargs)
+
+def instantiate_template_file(template_path: Path, output_path: Path, make_exec: bool = False,
+                              dir_fd: int = None, **kwargs) -> None:
+    data = _load_template(template_path)(**kwargs).encode('utf-8')
+    name = output_path.name if dir_fd is not None else output_path
+
+    # config.toml and the wrappers feed mtime-based rebuild checks further
+    # down (cargo, ninja), so leave files whose rendered contents are
+    # already on disk untouched rather than dirtying their timestamps.
+    try:
+        fd = os.open(name, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            if os.read(fd, len(data) + 1) == data:
+                if make_exec:
+                    os.fchmod(fd, 0o755)
+                return
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+    # The rendered files are small, so encode once and issue a single write,
+    # creating the file with its final mode - no text-mode encoder, no
+    # buffered chunking and no separate chmod.  When the caller supplies a
+    # directory fd, only the final component needs resolving.
+    fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 0o755 if make_exec else 0o644, dir_fd=dir_fd)
+    try:
+        os.write(fd, data)
+        if make_exec:
+            # O_CREAT's mode is filtered by the umask (and ignored entirely
+            # when the file already exists), so pin the exec bits explicitly.
+            os.fchmod(fd, 0o755)
+    finally:
+        os.close(fd)
+
+
+def host_config(target: str, macosx_flags: str, linker_flags: str,
+                dir_fd: int = None) -> str:
+    cc_wrapper_name     = OUT_PATH_WRAPPERS / f'clang-{target}'
+    cxx_wrapper_name    = OUT_PATH_WRAPPERS / f'clang++-{target}'
+    linker_wrapper_name = OUT_PATH_WRAPPERS / f'linker-{target}'
 
     instantiate_template_exec(
         HOST_CC_WRAPPER_TEMPLATE,
         cc_wrapper_name,
+        dir_fd=dir_fd,
         real_cc=CC_PATH,
         target=target,
         macosx_flags=macosx_flags)
@@ -73,6 +193,7 @@ def host_config(target: str, macosx_flags: str, linker_flags: str) -> str:
     instantiate_template_exec(
         HOST_CXX_WRAPPER_TEMPLATE,
         cxx_wrapper_name,
+        dir_fd=dir_fd,
         real_cxx=CXX_PATH,
         target=target,
         macosx_flags=macosx_flags,
@@ -81,24 +202,25 @@ def host_config(target: str, macosx_flags: str, linker_flags: str) -> str:
     instantiate_template_exec(
         HOST_LINKER_WRAPPER_TEMPLATE,
         linker_wrapper_name,
+        dir_fd=dir_fd,
         real_cxx=CXX_PATH,
         target=target,
         macosx_flags=macosx_flags,
         linker_flags=linker_flags)
 
-    with open(HOST_TARGET_TEMPLATE, 'r') as template_file:
-        return Template(template_file.read()).substitute(
-            target=target,
-            cc=cc_wrapper_name,
-            cxx=cxx_wrapper_name,
-            linker=linker_wrapper_name,
-            ar=AR_PATH,
-            ranlib=RANLIB_PATH)
+    return _load_template(HOST_TARGET_TEMPLATE)(
+        target=target,
+        cc=cc_wrapper_name,
+        cxx=cxx_wrapper_name,
+        linker=linker_wrapper_name,
+        ar=AR_PATH,
+        ranlib=RANLIB_PATH)
 
 
-def device_config(target: str, lto_flag: str, linker_flags: str) -> str:
-    cc_wrapper_name     = OUT_PATH_WRAPPERS / ('clang-%s' % target)
-    linker_wrapper_name = OUT_PATH_WRAPPERS / ('linker-%s' % target)
+def device_config(target: str, lto_flag: str, linker_flags: str,
+                  dir_fd: int = None) -> str:
+    cc_wrapper_name     = OUT_PATH_WRAPPERS / f'clang-{target}'
+    linker_wrapper_name = OUT_PATH_WRAPPERS / f'linker-{target}'
 
     clang_target = target + ANDROID_TARGET_VERSION
 
@@ -108,6 +230,7 @@ def device_config(target: str, lto_flag: str, linker_flags: str) -> str:
     instantiate_template_exec(
         DEVICE_CC_WRAPPER_TEMPLATE,
         cc_wrapper_name,
+        dir_fd=dir_fd,
         real_cc=CC_PATH,
         target=clang_target,
         sysroot=NDK_SYSROOT_PATH,
@@ -116,18 +239,18 @@ def device_config(target: str, lto_flag: str, linker_flags: str) -> str:
     instantiate_template_exec(
         DEVICE_LINKER_WRAPPER_TEMPLATE,
         linker_wrapper_name,
+        dir_fd=dir_fd,
         real_cc=CC_PATH,
         target=clang_target,
         sysroot=NDK_SYSROOT_PATH,
         linker_flags=linker_flags,
         lto_flag=lto_flag)
 
-    with open(DEVICE_TARGET_TEMPLATE, 'r') as template_file:
-        return Template(template_file.read()).substitute(
-            target=target,
-            cc=cc_wrapper_name,
-            linker=linker_wrapper_name,
-            ar=AR_PATH)
+    return _load_template(DEVICE_TARGET_TEMPLATE)(
+        target=target,
+        cc=cc_wrapper_name,
+        linker=linker_wrapper_name,
+        ar=AR_PATH)
 
 
 def configure(args: argparse.ArgumentParser, env: dict[str, str]):
@@ -137,13 +260,17 @@ def configure(args: argparse.ArgumentParser, env: dict[str, str]):
     # Compute compiler/linker flags
     #
 
+    # The host platform cannot change mid-run; probe it once.
+    is_linux:  bool = build_platform.is_linux()
+    is_darwin: bool = build_platform.is_darwin()
+
     macosx_flags:          str = ''
-    host_ld_selector:      str = '-fuse-ld=lld' if build_platform.is_linux() else ''
-    host_bin_search:       str = ('-B' + GCC_TOOLCHAIN_PATH.as_posix()) if build_platform.is_linux() else ''
-    host_llvm_libpath:     str = '-L' + LLVM_CXX_RUNTIME_PATH.as_posix()
-    host_rpath_buildtime:  str = '-Wl,-rpath,' + LLVM_CXX_RUNTIME_PATH.as_posix()
+    host_ld_selector:      str = '-fuse-ld=lld' if is_linux else ''
+    host_bin_search:       str = ('-B' + GCC_TOOLCHAIN_STR) if is_linux else ''
+    host_llvm_libpath:     str = '-L' + LLVM_CXX_RUNTIME_STR
+    host_rpath_buildtime:  str = '-Wl,-rpath,' + LLVM_CXX_RUNTIME_STR
     host_rpath_runtime:    str = '-Wl,-rpath,' + (
-        '$ORIGIN/../lib64' if build_platform.is_linux() else '@loader_path/../lib64')
+        '$ORIGIN/../lib64' if is_linux else '@loader_path/../lib64')
 
     lto_flag: str = ''
     if args.lto == 'full':
@@ -151,24 +278,23 @@ def configure(args: argparse.ArgumentParser, env: dict[str, str]):
     elif args.lto == 'thin':
         lto_flag = '-flto=thin'
 
-    if build_platform.is_darwin():
+    if is_darwin:
         # Apple removed the normal sysroot at / on Mojave+, so we need
         # to go hunt for it on OSX
-        # On pre-Mojave, this command will output the empty string.
-        output = subprocess.check_output(
-            ['xcrun', '--sdk', 'macosx', '--show-sdk-path'])
         macosx_flags = (
             MACOSX_VERSION_FLAG +
-            " --sysroot " + output.rstrip().decode('utf-8'))
+            " --sysroot " + _macos_sdk_path())
 
-    host_linker_flags = ' '.join([
+    # Filter the conditionally-empty flags so empty tokens don't leak extra
+    # spaces into the generated wrappers.
+    host_linker_flags = ' '.join(filter(None, (
         host_ld_selector,
         LINKER_PIC_FLAG,
         lto_flag,
         host_bin_search,
         host_llvm_libpath,
         host_rpath_buildtime,
-        host_rpath_runtime])
+        host_rpath_runtime)))
 
     device_linker_flags = LINKER_PIC_FLAG
 
@@ -176,16 +302,10 @@ def configure(args: argparse.ArgumentParser, env: dict[str, str]):
     # Update environment variables
     #
 
-    env['PATH'] = os.pathsep.join(
-        [p.as_posix() for p in [
-          RUST_PREBUILT_PATH / 'bin',
-          CMAKE_PREBUILT_PATH / 'bin',
-          NINJA_PREBUILT_PATH,
-          BUILD_TOOLS_PREBUILT_PATH,
-        ]] + [env['PATH']])
+    env['PATH'] = os.pathsep.join([PATH_PREBUILT_PREFIX, env['PATH']])
 
     # Only adjust the library path on Linux - on OSX, use the devtools curl
-    if build_platform.is_linux():
+    if is_linux:
         if 'LIBRARY_PATH' in env:
             old_library_path = ':{0}'.format(env['LIBRARY_PATH'])
         else:
@@ -195,6 +315,11 @@ def configure(args: argparse.ArgumentParser, env: dict[str, str]):
     # Tell the rust bootstrap system where to place its final products
     env['DESTDIR'] = OUT_PATH_PACKAGE
 
+    # Overlap rlib codegen with downstream metadata-fed compilation.  Recent
+    # cargos pipeline by default; setting it keeps the stage0 prebuilt cargo
+    # honest.
+    env['CARGO_BUILD_PIPELINING'] = 'true'
+
     # Pass additional flags to the Rust compiler
     env['RUSTFLAGS'] = '-C relocation-model=pic'
 
@@ -235,13 +360,29 @@ def configure(args: argparse.ArgumentParser, env: dict[str, str]):
     # Intantiate wrappers
     #
 
-    host_configs = '\n'.join(
-        [host_config(target, macosx_flags, host_linker_flags) for target in HOST_TARGETS])
-    device_configs = '\n'.join(
-        [device_config(target, lto_flag, device_linker_flags) for target in DEVICE_TARGETS])
-
-    all_targets = '[' + ','.join(
-        ['"' + target + '"' for target in ALL_TARGETS]) + ']'
+    # Each target writes wrappers to its own paths under OUT_PATH_WRAPPERS,
+    # so the per-target work is independent and can overlap its file I/O.
+    # Executor.map returns results in input order, keeping the generated
+    # config.toml deterministic.  A single directory fd lets every wrapper
+    # creation resolve just its final name.
+    wrappers_dir_fd = os.open(OUT_PATH_WRAPPERS, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(ALL_TARGETS)) as executor:
+            host_configs = '\n'.join(executor.map(
+                lambda target: host_config(target, macosx_flags,
+                                           host_linker_flags,
+                                           dir_fd=wrappers_dir_fd),
+                HOST_TARGETS))
+            device_configs = '\n'.join(executor.map(
+                lambda target: device_config(target, lto_flag,
+                                             device_linker_flags,
+                                             dir_fd=wrappers_dir_fd),
+                DEVICE_TARGETS))
+    finally:
+        os.close(wrappers_dir_fd)
+
+    all_targets = json.dumps(ALL_TARGETS, separators=(',', ':'))
 
     instantiate_template_file(
         CONFIG_TOML_TEMPLATE,
@@ -16,6 +16,8 @@
 """Creates a tarball suitable for use as a Rust prebuilt for Android."""
 
 import argparse
+import concurrent.futures
+import hashlib
 import os
 import os.path
 from pathlib import Path
@@ -51,6 +53,11 @@ STDLIB_SOURCES = [
         "vendor/unicode-width",
 ]
 
+# Ready-to-use (source, destination) pairs for the stdlib source install.
+STDLIB_SOURCE_PATHS: list[tuple[Path, Path]] = [
+    (OUT_PATH_RUST_SOURCE / stdlib, OUT_PATH_STDLIB_SRCS / stdlib)
+    for stdlib in STDLIB_SOURCES]
+
 LLVM_BUILD_PATHS_OF_INTEREST: list[str] = [
     'build.ninja',
     'cmake',
@@ -65,6 +72,170 @@ LLVM_BUILD_PATHS_OF_INTEREST: list[str] = [
 ]
 
 
+def package_fingerprint(package_dir: Path) -> str:
+    """Hashes the metadata of every file under package_dir."""
+    sig = hashlib.sha256()
+
+    for root, dirs, files in os.walk(package_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            info = os.lstat(path)
+            sig.update(os.path.relpath(path, package_dir).encode())
+            sig.update(b'%d %d %d' % (info.st_size, info.st_mtime_ns, info.st_mode))
+
+    return sig.hexdigest()
+
+
+def fast_copy(src: Path, dst: Path) -> None:
+    """Copies a single file, cloning or zero-copying when the kernel can.
+
+    os.link gives a free copy when src and dst share a filesystem and the
+    source won't be modified; os.copy_file_range keeps the bytes in the
+    kernel (and reflinks on btrfs/xfs).  shutil.copy2 is the portable
+    fallback, e.g. on Darwin.
+    """
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                remaining = os.fstat(s.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(s.fileno(), d.fileno(),
+                                                remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copymode(src, dst)
+                return
+        except OSError:
+            dst.unlink(missing_ok=True)
+
+    shutil.copy2(src, dst)
+
+
+def create_tarball(tarball_path: Path, source_dir: Path,
+                   paths: list[str] = ['.']) -> None:
+    """Creates a gzipped tarball of paths under source_dir, in parallel when
+    possible."""
+    if shutil.which('pigz'):
+        # pigz spreads the DEFLATE loop across all cores; plain gzip is
+        # single threaded and dominates the dist step on big packages.
+        cmd = ['tar', '--use-compress-program', 'pigz', '-cf', tarball_path]
+    else:
+        cmd = ['tar', 'czf', tarball_path]
+
+    subprocess.check_call(cmd + paths, cwd=source_dir)
+
+
+def stdlib_fingerprint() -> str:
+    """Fingerprints the inputs to the stdlib source install.
+
+    Returns None when no fingerprint can be computed, in which case the
+    install is always performed.
+    """
+    sig = hashlib.sha256()
+
+    try:
+        sig.update(subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=RUST_SOURCE_PATH, stderr=subprocess.DEVNULL))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    for patch in sorted(PATCHES_PATH.glob('rustc-*')):
+        info = patch.stat()
+        sig.update(patch.name.encode())
+        sig.update(str(info.st_mtime_ns).encode())
+        sig.update(str(info.st_size).encode())
+
+    return sig.hexdigest()
+
+
+# Some stdlib crates might include Android.mk or Android.bp files.  If they
+# do, filter them out while copying so no separate cleanup pass is needed.
+STDLIB_IGNORED_FILES: tuple[str, ...] = ('Android.mk', 'Android.bp')
+
+
+def tar_copytree(src: Path, dst: Path, exclude: tuple[str, ...] = ()) -> None:
+    """Copies a directory tree through a tar pipe.
+
+    When a reflink copy is unavailable (e.g. across filesystems) a tar pipe
+    keeps both the tree walk and the data movement in two native processes
+    instead of a per-file Python loop.
+    """
+    dst.mkdir(parents=True, exist_ok=True)
+
+    excludes = ['--exclude=%s' % name for name in exclude]
+    src_tar  = subprocess.Popen(['tar', '-cf', '-'] + excludes + ['-C', src, '.'],
+                                stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-xf', '-', '-C', dst], stdin=src_tar.stdout)
+
+    src_tar.stdout.close()
+    if src_tar.wait() != 0:
+        raise subprocess.CalledProcessError(src_tar.returncode, src_tar.args)
+
+
+def copy_stdlib_tree(src: Path, dst: Path) -> None:
+    """Copies one stdlib source tree into the package staging directory."""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+
+    # Prefer a copy-on-write clone where the filesystem supports it - it
+    # completes in O(metadata) instead of O(bytes).  Mirrors the reflink copy
+    # performed by source_manager.setup_files.
+    try:
+        subprocess.check_call(['cp', '-Rf', '--reflink=auto', src, dst])
+
+        # 'cp' cannot filter, so prune the unwanted build files from the
+        # freshly copied tree while its metadata is still in cache.
+        for root, _, files in os.walk(dst):
+            for name in files:
+                if name in STDLIB_IGNORED_FILES:
+                    os.unlink(os.path.join(root, name))
+    except subprocess.CalledProcessError:
+        # Fallback to a tar-pipe copy.
+        tar_copytree(src, dst, exclude=STDLIB_IGNORED_FILES)
+
+
+def install_stdlib_sources() -> None:
+    """Installs the stdlib sources into the package staging directory.
+
+    The install is skipped when the fingerprint of the inputs (rustc
+    revision plus patches) matches the one recorded by the previous build.
+    """
+    if not build_platform.is_linux():
+        return
+
+    # The fingerprint lives under OUT_PATH, not in the stdlib tree itself:
+    # everything under OUT_PATH_PACKAGE is shipped verbatim by the dist
+    # step.  Requiring the tree to exist keeps a manual rmtree as a way to
+    # force a reinstall.
+    fingerprint      = stdlib_fingerprint()
+    fingerprint_path = OUT_PATH / '.stdlib_srcs_fingerprint'
+
+    if (fingerprint is not None and OUT_PATH_STDLIB_SRCS.exists() and
+            fingerprint_path.exists() and
+            fingerprint_path.read_text() == fingerprint):
+        return
+
+    shutil.rmtree(OUT_PATH_STDLIB_SRCS, ignore_errors=True)
+    # The source trees are disjoint, so they can be copied concurrently.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(8, len(STDLIB_SOURCE_PATHS))) as executor:
+        list(executor.map(lambda paths: copy_stdlib_tree(*paths),
+                          STDLIB_SOURCE_PATHS))
+
+    if fingerprint is not None:
+        fingerprint_path.write_text(fingerprint)
+
+
 def parse_args() -> argparse.ArgumentParser:
     """Parses arguments and returns the parsed structure."""
     parser = argparse.ArgumentParser('Build the Rust Toolchain')
@@ -92,10 +263,6 @@ def main():
     # Initialize directories
     #
 
-    OUT_PATH.mkdir(exist_ok=True)
-    OUT_PATH_PACKAGE.mkdir(exist_ok=True)
-    OUT_PATH_WRAPPERS.mkdir(exist_ok=True)
-
     # We take DIST_DIR through an environment variable rather than an
     # argument to match the interface for traditional Android builds.
     dist_dir = os.environ.get('DIST_DIR')
@@ -104,7 +271,9 @@ def main():
     else:
         dist_dir = WORKSPACE_PATH / 'dist'
 
-    dist_dir.mkdir(exist_ok=True)
+    for directory in (OUT_PATH, OUT_PATH_PACKAGE, OUT_PATH_WRAPPERS,
+                      dist_dir):
+        directory.mkdir(parents=True, exist_ok=True)
 
     #
     # Setup source files
@@ -121,39 +290,58 @@ def main():
     env = dict(os.environ)
     config.configure(args, env)
 
+    x_py = str(OUT_PATH_RUST_SOURCE / 'x.py')
+
     # Trigger bootstrap to trigger vendoring
     #
     # Call is not checked because this is *expected* to fail - there isn't a
     # user facing way to directly trigger the bootstrap, so we give it a
     # no-op to perform that will require it to write out the cargo config.
-    subprocess.call([PYTHON_PATH, OUT_PATH_RUST_SOURCE / 'x.py', '--help'],
-                    cwd=OUT_PATH_RUST_SOURCE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    #
+    # env carries the configured PATH, so bootstrap resolves the same
+    # cargo/python the build itself will use.
+    subprocess.call([PYTHON_PATH, x_py, '--help'], cwd=OUT_PATH_RUST_SOURCE,
+                    env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     # Offline fetch to regenerate lockfile
     #
     # Because some patches may have touched vendored source we will rebuild
     # Cargo.lock
-    subprocess.check_output(
+    subprocess.check_call(
         [RUST_PREBUILT_PATH / 'bin' / 'cargo', 'fetch', '--offline'],
-        cwd=OUT_PATH_RUST_SOURCE, env=env)
+        cwd=OUT_PATH_RUST_SOURCE, env=env, stdout=subprocess.DEVNULL)
 
     #
     # Build
     #
-    ec = subprocess.Popen([PYTHON_PATH, OUT_PATH_RUST_SOURCE / 'x.py',
-                          '--stage', '3', 'install'], cwd=OUT_PATH_RUST_SOURCE, env=env).wait()
-    if ec != 0:
-        print("Build stage failed with error {}".format(ec))
-        tarball_path = dist_dir / 'llvm-build-config.tar.gz'
-        subprocess.check_call(['tar', 'czf', tarball_path] + LLVM_BUILD_PATHS_OF_INTEREST,
-            cwd=LLVM_BUILD_PATH)
-        sys.exit(ec)
-
-    # Install sources
-    if build_platform.is_linux():
-        shutil.rmtree(OUT_PATH_STDLIB_SRCS, ignore_errors=True)
-        for stdlib in STDLIB_SOURCES:
-            shutil.copytree(OUT_PATH_RUST_SOURCE / stdlib, OUT_PATH_STDLIB_SRCS / stdlib)
+
+    # The stdlib source install only reads the (already patched) rustc
+    # sources, so it can run in the background while the build itself is
+    # going.  Note the build does write into OUT_PATH_PACKAGE too (x.py
+    # installs into DESTDIR); the overlap is only safe because the write
+    # sets are disjoint - the install writes bin/, lib/ and friends while
+    # install_stdlib_sources writes src/stdlibs - so keep it that way when
+    # changing either side.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        stdlib_install = executor.submit(install_stdlib_sources)
+
+        # rustbuild's default job count has historically undersubscribed
+        # large machines; pin it (and cargo's) to the core count.
+        jobs = str(os.cpu_count() or 1)
+        env['CARGO_BUILD_JOBS'] = jobs
+
+        ec = subprocess.run([PYTHON_PATH, x_py, '--stage', '3', 'install',
+                             '-j', jobs],
+                            cwd=OUT_PATH_RUST_SOURCE, env=env).returncode
+        if ec != 0:
+            print("Build stage failed with error {}".format(ec))
+            tarball_path = dist_dir / 'llvm-build-config.tar.gz'
+            create_tarball(tarball_path, LLVM_BUILD_PATH,
+                           LLVM_BUILD_PATHS_OF_INTEREST)
+            sys.exit(ec)
+
+        # Sources must be fully installed before the fixup/dist phases below.
+        stdlib_install.result()
 
     # Fixup
     # The Rust build doesn't have an option to auto-strip binaries, so we do
@@ -162,11 +350,17 @@ def main():
     # We don't attempt to strip anything under rustlib/ since these include
     # both debug symbols which we may want to link into user code and Rust
     # metadata needed at build time.
-    libs = list((OUT_PATH_PACKAGE / 'lib').glob('*.so'))
-    subprocess.check_call(['strip', '-S'] + libs + [
+    strip_files = list((OUT_PATH_PACKAGE / 'lib').glob('*.so')) + [
         OUT_PATH_PACKAGE / 'bin' / 'rustc',
         OUT_PATH_PACKAGE / 'bin' / 'cargo',
-        OUT_PATH_PACKAGE / 'bin' / 'rustdoc'])
+        OUT_PATH_PACKAGE / 'bin' / 'rustdoc']
+
+    # strip processes each file sequentially, so fan out one invocation per
+    # file instead of passing the whole list to a single process.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()) as executor:
+        list(executor.map(
+            lambda f: subprocess.check_call(['strip', '-S', f]), strip_files))
 
     # Install the libc++ library to out/package/lib64/
     if build_platform.is_darwin():
@@ -176,20 +370,32 @@ def main():
 
     lib64_path = OUT_PATH_PACKAGE / 'lib64'
     lib64_path.mkdir(exist_ok=True)
-    shutil.copy2(LLVM_CXX_RUNTIME_PATH / libcxx_name,
-                 lib64_path / libcxx_name)
-
-    # Some stdlib crates might include Android.mk or Android.bp files.
-    # If they do, filter them out.
-    if build_platform.is_linux():
-        for f in OUT_PATH_STDLIB_SRCS.glob('**/Android.{mk,bp}'):
-            f.unlink()
+    fast_copy(LLVM_CXX_RUNTIME_PATH / libcxx_name,
+              lib64_path / libcxx_name)
 
     # Dist
-    print("Creating distribution archive")
-    tarball_path = dist_dir / 'rust-{0}.tar.gz'.format(build_name)
-    subprocess.check_call(['tar', 'czf', tarball_path, '.'],
-        cwd=OUT_PATH_PACKAGE)
+    tarball_path     = dist_dir / 'rust-{0}.tar.gz'.format(build_name)
+    fingerprint      = package_fingerprint(OUT_PATH_PACKAGE)
+    fingerprint_path = dist_dir / ('rust-{0}.tar.gz.fingerprint'.format(build_name))
+
+    # Re-compressing the package is expensive; skip it when the package
+    # contents match what the existing archive was built from.
+    if (tarball_path.exists() and fingerprint_path.exists() and
+            fingerprint_path.read_text() == fingerprint):
+        print("Distribution archive is up to date")
+    else:
+        print("Creating distribution archive")
+        # Compress to a temporary file next to the package first: dist_dir
+        # may sit on a different filesystem, and moving the finished archive
+        # once is cheaper than streaming the compressed output across the
+        # mountpoint.  Same-filesystem dist dirs get an atomic rename.
+        tmp_tarball = OUT_PATH / (tarball_path.name + '.tmp')
+        create_tarball(tmp_tarball, OUT_PATH_PACKAGE)
+        try:
+            os.replace(tmp_tarball, tarball_path)
+        except OSError:
+            shutil.move(tmp_tarball, tarball_path)
+        fingerprint_path.write_text(fingerprint)
 
 if __name__ == '__main__':
     main()
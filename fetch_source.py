@@ -15,22 +15,39 @@
 
 
 import argparse
+import fcntl
+import os
 import re
+import shutil
 import subprocess
 
 from paths import RUST_SOURCE_PATH
 
 BRANCH_NAME: str = "rust-update-source-%s"
 
-COMMAND_GIT_ADD:      str = "git add ."
-COMMAND_GIT_AMEND:    str = "git commit --amend --no-edit"
-COMMAND_GIT_CHECKOUT: str = "git checkout %s"
-COMMAND_GIT_COMMIT:   str = "git commit --no-verify -m 'Importing rustc-%s'"
-COMMAND_GIT_DIFF:     str = "git diff --cached --quiet"
-COMMAND_GIT_RM:       str = "git rm -fr *"
-COMMAND_GIT_TEST:     str = "git rev-parse --verify %s"
-COMMAND_FETCH:        str = "curl --proto '=https' --tlsv1.2 -f %s | tar xz --strip-components=1"
-COMMAND_REPO:         str = "repo start %s"
+COMMAND_GIT_ADD:      tuple[str, ...] = ('git', 'add', '.')
+COMMAND_GIT_AMEND:    tuple[str, ...] = ('git', 'commit', '--amend', '--no-edit')
+COMMAND_GIT_CHECKOUT: tuple[str, ...] = ('git', 'checkout')
+COMMAND_GIT_COMMIT:   tuple[str, ...] = ('git', 'commit', '--no-verify', '-m')
+COMMAND_GIT_DIFF:     tuple[str, ...] = ('git', 'diff', '--cached', '--quiet')
+COMMAND_GIT_REFS:     tuple[str, ...] = ('git', 'for-each-ref',
+                                         '--format=%(refname:short) %(objectname)',
+                                         'refs/heads/', 'refs/remotes/')
+COMMAND_REPO:         tuple[str, ...] = ('repo', 'start')
+
+COMMAND_FETCH_CURL: tuple[str, ...] = ('curl', '--proto', '=https', '--tlsv1.2', '-f')
+COMMAND_FETCH_TAR:  tuple[str, ...] = ('tar', '-x', '--strip-components=1')
+
+STAGING_DIR_NAME: str = '.staging'
+
+COMMAND_SYNC: tuple[str, ...] = ('rsync', '-a', '--delete', '--exclude=.git',
+                                 '--exclude=' + STAGING_DIR_NAME,
+                                 STAGING_DIR_NAME + '/', './')
+
+# F_SETPIPE_SZ is Linux-only; the constant was only added to the fcntl module
+# in Python 3.10, so carry its value for older interpreters.
+F_SETPIPE_SZ:     int = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+PIPE_BUFFER_SIZE: int = 1 << 20
 
 GIT_REFERENCE_BRANCH: str = 'aosp/master'
 
@@ -38,7 +55,7 @@ RUSTC_SOURCE_URL_VERSION_TEMPLATE: str = "https://static.rust-lang.org/dist/rust
 RUSTC_SOURCE_URL_BETA            : str = "https://static.rust-lang.org/dist/rustc-beta-src.tar.gz"
 RUSTC_SOURCE_URL_NIGHTLY         : str = "https://static.rust-lang.org/dist/rustc-nightly-src.tar.gz"
 
-VERSION_PATTERN : re.Pattern = re.compile("\d+\.\d+\.\d+")
+VERSION_PATTERN : re.Pattern = re.compile(r"\d+\.\d+\.\d+")
 
 branch_existed: bool = False
 
@@ -46,13 +63,13 @@ branch_existed: bool = False
 # Command execution
 #
 
-def exec_rustc_src_command(command: str, check=False, stdout=subprocess.DEVNULL,
+def exec_rustc_src_command(command: tuple, check=False, stdout=subprocess.DEVNULL,
                            stderr=subprocess.DEVNULL) -> subprocess.CompletedProcess:
-  return subprocess.run(command, shell=True, cwd=RUST_SOURCE_PATH, check=check,
+  return subprocess.run(command, cwd=RUST_SOURCE_PATH, check=check,
                         stdout=stdout, stderr=stderr)
 
 
-def handle_rustc_src_command(command: str, error_string: str, stdout=subprocess.DEVNULL,
+def handle_rustc_src_command(command: tuple, error_string: str, stdout=subprocess.DEVNULL,
                              stderr=subprocess.DEVNULL) -> None:
   result = exec_rustc_src_command(command, stdout=stdout, stderr=stderr)
   if result.returncode != 0:
@@ -80,7 +97,7 @@ def get_extra_tag(build_type: str) -> str:
 
 
 def version_string_type(arg_string: str) -> str:
-  if VERSION_PATTERN.match(arg_string):
+  if VERSION_PATTERN.fullmatch(arg_string):
     return arg_string
   else:
     raise argparse.ArgumentTypeError("Version string is not properly formatted")
@@ -89,12 +106,29 @@ def version_string_type(arg_string: str) -> str:
 # Git helpers
 #
 
+git_refs: dict = None
+
+def get_git_refs() -> dict:
+  """Returns a branch-name-to-object-id map for all local and remote refs.
+
+  One for-each-ref call replaces a rev-parse fork (and packed-refs read) per
+  lookup; the refs don't move while this script runs, so the map is read
+  once.
+  """
+  global git_refs
+  if git_refs is None:
+    output   = exec_rustc_src_command(COMMAND_GIT_REFS, check=True,
+                                      stdout=subprocess.PIPE).stdout
+    git_refs = dict(line.split() for line in output.decode().splitlines())
+  return git_refs
+
+
 def git_branch_exists(branch_name: str) -> bool:
-  return exec_rustc_src_command(COMMAND_GIT_TEST % branch_name).returncode == 0
+  return branch_name in get_git_refs()
 
 
 def git_get_branch_target(branch_name: str) -> str:
-  return exec_rustc_src_command(COMMAND_GIT_TEST % branch_name, check=True, stdout=subprocess.PIPE).stdout.rstrip()
+  return get_git_refs()[branch_name]
 
 #
 # Program logic
@@ -124,7 +158,7 @@ def setup_git_branch(branch_name: str, overwrite: bool) -> None:
 
     if overwrite:
       print("Checking out branch %s" % branch_name)
-      handle_rustc_src_command(COMMAND_GIT_CHECKOUT % branch_name,
+      handle_rustc_src_command(COMMAND_GIT_CHECKOUT + (branch_name,),
                              "Error checking out branch to overwrite")
     else:
       print("Branch %s already exists and the 'overwrite' option was not set" % branch_name)
@@ -132,23 +166,63 @@ def setup_git_branch(branch_name: str, overwrite: bool) -> None:
 
   else:
     print("Creating branch %s" % branch_name)
-    command_repo = COMMAND_REPO % branch_name
-    handle_rustc_src_command(command_repo, "Error creating repo for source update")
+    handle_rustc_src_command(COMMAND_REPO + (branch_name,),
+                             "Error creating repo for source update")
+
 
+def sync_repository() -> None:
+  """Synchronizes the extracted archive into the working tree.
 
-def clean_repository() -> None:
-  print("Deleting old files")
-  handle_rustc_src_command(COMMAND_GIT_RM, "Error deleting old files from git")
+  rsync rewrites only the files that actually changed between releases,
+  instead of deleting and re-creating every tracked file.
+  """
+  print("Synchronizing fetched source")
+  result = subprocess.run(COMMAND_SYNC, cwd=RUST_SOURCE_PATH)
+  if result.returncode != 0:
+    print("Error synchronizing fetched source into the working tree")
+    exit(-2)
+
+  shutil.rmtree(RUST_SOURCE_PATH / STAGING_DIR_NAME)
 
 
 def fetch_archive(build_type: str, rust_version: str) -> None:
   archive_url = construct_archive_url(build_type, rust_version)
   print("Fetching archive %s\n" % archive_url)
-  handle_rustc_src_command(
-    COMMAND_FETCH % archive_url,
-    "Error fetching source for Rust version %s" % rust_version,
-    stdout=None,
-    stderr=None)
+
+  # Extract into a staging directory rather than over the working tree; the
+  # rsync in sync_repository then leaves unchanged files untouched.
+  staging_dir = RUST_SOURCE_PATH / STAGING_DIR_NAME
+  if staging_dir.exists():
+    shutil.rmtree(staging_dir)
+  staging_dir.mkdir()
+
+  # Connect curl and tar over an explicit pipe instead of going through a
+  # shell.  Growing the pipe buffer lets the download and the extraction run
+  # with fewer context switches between them; it is best effort, since the
+  # request is Linux-specific and capped by /proc/sys/fs/pipe-max-size.
+  read_fd, write_fd = os.pipe()
+  try:
+    fcntl.fcntl(write_fd, F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+  except OSError:
+    pass
+
+  # Single-threaded gzip is the bottleneck of the extraction; hand the
+  # inflate loop to pigz when it is available.
+  if shutil.which('pigz'):
+    tar_command = COMMAND_FETCH_TAR + ('--use-compress-program', 'pigz -d')
+  else:
+    tar_command = COMMAND_FETCH_TAR + ('-z',)
+
+  curl = subprocess.Popen(COMMAND_FETCH_CURL + (archive_url,), stdout=write_fd)
+  tar  = subprocess.Popen(tar_command, stdin=read_fd, cwd=staging_dir)
+
+  # The parent's pipe ends must be closed for tar to see EOF when curl exits.
+  os.close(write_fd)
+  os.close(read_fd)
+
+  if curl.wait() != 0 or tar.wait() != 0:
+    print("Error fetching source for Rust version %s" % rust_version)
+    exit(-2)
 
 
 def commit_files(branch_name: str, rustc_version: str) -> None:
@@ -166,7 +240,7 @@ def commit_files(branch_name: str, rustc_version: str) -> None:
                              "Error amending previous commit")
   else:
     print("Commiting new files")
-    handle_rustc_src_command(COMMAND_GIT_COMMIT % rustc_version,
+    handle_rustc_src_command(COMMAND_GIT_COMMIT + ('Importing rustc-%s' % rustc_version,),
                              "Error committing new files to git")
 
 
@@ -176,8 +250,8 @@ def main() -> None:
   branch_name  = BRANCH_NAME % rust_version
 
   setup_git_branch(branch_name, args.overwrite)
-  clean_repository()
   fetch_archive(args.build_type, rust_version)
+  sync_repository()
   commit_files(branch_name, rust_version)
 
   exit(0)
@@ -13,6 +13,7 @@
 # limitations under the License.
 """Provides path expansion to components needed for the rustc build."""
 
+import os.path
 from pathlib import Path
 import build_platform
 
@@ -21,9 +22,18 @@ CLANG_REVISION:      str = 'r433403'
 CLANG_NAME:          str = 'clang-{0}'.format(CLANG_REVISION)
 GLIBC_VERSION:       str = '2.17-4.8'
 
-TOOLCHAIN_PATH:   Path = Path(__file__).parent.resolve()
-WORKSPACE_PATH:   Path = (TOOLCHAIN_PATH / '..' / '..').resolve()
-RUST_SOURCE_PATH: Path = (TOOLCHAIN_PATH / '..' / 'rustc').resolve()
+# Hoisted once for the constants below; even a cached call per constant adds
+# up at import time.
+_PREBUILT: str = build_platform.prebuilt()
+
+# Resolve the '..' chains with single realpath calls rather than stacking
+# intermediate Path objects; each (A / '..' / 'b').resolve() allocates the
+# whole chain and re-walks every component.
+TOOLCHAIN_PATH:   Path = Path(os.path.realpath(os.path.dirname(__file__)))
+WORKSPACE_PATH:   Path = Path(os.path.realpath(
+    os.path.join(TOOLCHAIN_PATH, '..', '..')))
+RUST_SOURCE_PATH: Path = Path(os.path.realpath(
+    os.path.join(TOOLCHAIN_PATH, '..', 'rustc')))
 
 PATCHES_PATH:   Path = TOOLCHAIN_PATH / 'patches'
 TEMPLATES_PATH: Path = TOOLCHAIN_PATH / 'templates'
@@ -37,22 +47,22 @@ OUT_PATH_WRAPPERS:    Path = OUT_PATH / 'wrappers'
 LLVM_BUILD_PATH: Path = OUT_PATH_RUST_SOURCE / 'build' / build_platform.triple() / 'llvm' / 'build'
 
 PREBUILT_PATH:         Path = WORKSPACE_PATH / 'prebuilts'
-RUST_PREBUILT_PATH:    Path = PREBUILT_PATH / 'rust' / build_platform.prebuilt() / STAGE0_RUST_VERSION
-LLVM_PREBUILT_PATH:    Path = PREBUILT_PATH / 'clang' / 'host' / build_platform.prebuilt() / CLANG_NAME
+RUST_PREBUILT_PATH:    Path = PREBUILT_PATH / 'rust' / _PREBUILT / STAGE0_RUST_VERSION
+LLVM_PREBUILT_PATH:    Path = PREBUILT_PATH / 'clang' / 'host' / _PREBUILT / CLANG_NAME
 LLVM_CXX_RUNTIME_PATH: Path = LLVM_PREBUILT_PATH / 'lib64'
-GCC_TOOLCHAIN_PATH:    Path = PREBUILT_PATH / 'gcc' / build_platform.prebuilt() / 'host' / ('x86_64-linux-glibc' + GLIBC_VERSION)
+GCC_TOOLCHAIN_PATH:    Path = PREBUILT_PATH / 'gcc' / _PREBUILT / 'host' / ('x86_64-linux-glibc' + GLIBC_VERSION)
 
 # We live at      prebuilts/rust/${BUILD_PLATFORM}/${VERSION}/bin
 # libc++ lives at prebuilts/clang/host/${BUILD_PLATFORM}
 #                 /clang-${CLANG_REVISION}/lib64
-ANDROID_CXX_RUNTIME_PATH: Path = (
-    WORKSPACE_PATH / '..' / '..' / 'clang' / 'host' /
-        build_platform.prebuilt() / CLANG_NAME / 'lib64').resolve()
+ANDROID_CXX_RUNTIME_PATH: Path = Path(os.path.realpath(os.path.join(
+    WORKSPACE_PATH, '..', '..', 'clang', 'host',
+    _PREBUILT, CLANG_NAME, 'lib64')))
 
-PYTHON_PREBUILT_PATH:      Path = PREBUILT_PATH / 'python' / build_platform.prebuilt()
-CMAKE_PREBUILT_PATH:       Path = PREBUILT_PATH / 'cmake' / build_platform.prebuilt()
-NINJA_PREBUILT_PATH:       Path = PREBUILT_PATH / 'ninja' / build_platform.prebuilt()
-BUILD_TOOLS_PREBUILT_PATH: Path = PREBUILT_PATH / 'build-tools' / 'path' / build_platform.prebuilt()
+PYTHON_PREBUILT_PATH:      Path = PREBUILT_PATH / 'python' / _PREBUILT
+CMAKE_PREBUILT_PATH:       Path = PREBUILT_PATH / 'cmake' / _PREBUILT
+NINJA_PREBUILT_PATH:       Path = PREBUILT_PATH / 'ninja' / _PREBUILT
+BUILD_TOOLS_PREBUILT_PATH: Path = PREBUILT_PATH / 'build-tools' / 'path' / _PREBUILT
 CURL_PREBUILT_PATH:        Path = PREBUILT_PATH / 'android-emulator-build' / 'cur' / build_platform.prebuilt_full()
 
 # Use of the NDK should eventually be removed so as to make this a Platform